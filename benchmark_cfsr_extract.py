@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+
+Purpose: Benchmark the in-process CFSR surface pressure extraction against
+         extract_ncep_cfsr_psfc.csh, and verify that both produce
+         byte-identical flat binary files.
+
+Usage: benchmark_cfsr_extract.py DIST_ROOT CFSR_FILE [CFSR_FILE ...]
+
+Copyright (c) 2015 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import sys
+from os.path import basename, abspath, join as pjoin
+import time
+import shutil
+import tempfile
+import logging
+from subprocess import check_call
+
+from flo.sw.hirs_tpw_orbital import cfsr
+from flo.sw.hirs2nc.utils import setup_logging
+
+# every module should have a LOG object
+LOG = logging.getLogger(__name__)
+
+
+def run_script(dist_root, cfsr_file, output_file):
+    extract_cfsr_bin = pjoin(dist_root, 'extract_ncep_cfsr_psfc.csh')
+    check_call([extract_cfsr_bin, dist_root, cfsr_file, output_file])
+
+
+def run_inprocess(dist_root, cfsr_file, output_file):
+    cfsr.extract_psfc_bin(cfsr_file, output_file)
+
+
+def benchmark(dist_root, cfsr_files, repeats=3):
+    '''
+    Time both extractors on each file. An untimed warm-up run of each method
+    primes the page cache, and the order of the methods alternates between
+    repeats, so neither benefits from running after the other.
+    '''
+
+    work_dir = tempfile.mkdtemp(prefix='cfsr_bench_')
+    timings = {'script': [], 'inprocess': []}
+    mismatches = []
+
+    try:
+        for cfsr_file in cfsr_files:
+            cfsr_file = abspath(cfsr_file)
+            methods = [('script', run_script), ('inprocess', run_inprocess)]
+            outputs = dict((name, pjoin(work_dir, '{}.{}.bin'.format(basename(cfsr_file), name)))
+                           for name, _ in methods)
+
+            for name, func in methods:
+                func(dist_root, cfsr_file, outputs[name])
+
+            for _ in range(repeats):
+                for name, func in methods:
+                    t0 = time.time()
+                    func(dist_root, cfsr_file, outputs[name])
+                    timings[name].append(time.time() - t0)
+                methods.reverse()
+
+            if cfsr.compare_bin(outputs['script'], outputs['inprocess']):
+                LOG.info("{}: outputs are byte-identical".format(basename(cfsr_file)))
+            else:
+                LOG.error("{}: outputs differ".format(basename(cfsr_file)))
+                mismatches.append(cfsr_file)
+    finally:
+        shutil.rmtree(work_dir)
+
+    for name in ['script', 'inprocess']:
+        LOG.info("{:>10}: {} runs, mean {:.3f}s, min {:.3f}s".format(
+            name, len(timings[name]),
+            sum(timings[name]) / len(timings[name]), min(timings[name])))
+
+    return mismatches
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    setup_logging(2)
+
+    if not cfsr.have_inprocess_extractor():
+        LOG.error("eccodes is not available, cannot run the in-process extractor")
+        sys.exit(1)
+
+    mismatches = benchmark(sys.argv[1], sys.argv[2:])
+    sys.exit(1 if mismatches else 0)
@@ -13,6 +13,7 @@ from os.path import basename, dirname, curdir, abspath, isdir, isfile, exists, s
 import sys
 from glob import glob
 import shutil
+import time
 import logging
 import traceback
 from subprocess import CalledProcessError
@@ -41,14 +42,24 @@ import flo.sw.hirs2nc as hirs2nc
 import flo.sw.hirs_ctp_orbital as hirs_ctp_orbital
 from flo.sw.hirs2nc.delta import DeltaCatalog
 from flo.sw.hirs2nc.utils import link_files
+from flo.sw.hirs_tpw_orbital import cfsr
+from flo.sw.hirs_tpw_orbital.planner import record_metrics, metrics_file_from_env
 
 # every module should have a LOG object
 LOG = logging.getLogger(__name__)
 
+# Per-task runtime and I/O are appended here for the campaign planner, if set. This
+# must be on a filesystem shared by the task hosts and the submitting host.
+metrics_file = metrics_file_from_env()
+
 def set_input_sources(input_locations):
     global delta_catalog
     delta_catalog = DeltaCatalog(**input_locations)
 
+def set_metrics_file(filename):
+    global metrics_file
+    metrics_file = abspath(filename) if filename else None
+
 class HIRS_TPW_ORBITAL(Computation):
 
     parameters = ['granule', 'satellite', 'hirs2nc_delivery_id', 'hirs_avhrr_delivery_id',
@@ -57,6 +68,10 @@ class HIRS_TPW_ORBITAL(Computation):
                   'hirs_ctp_monthly_delivery_id', 'hirs_tpw_orbital_delivery_id']
     outputs = ['shift', 'noshift']
 
+    # Extract the CFSR surface pressure in-process rather than with extract_ncep_cfsr_psfc.csh.
+    # Unverified: byte-identical output against the script is not yet confirmed (see cfsr.py).
+    extract_cfsr_in_process = False
+
     def find_contexts(self, time_interval, satellite, hirs2nc_delivery_id, hirs_avhrr_delivery_id,
                       hirs_csrb_daily_delivery_id, hirs_csrb_monthly_delivery_id,
                       hirs_ctp_orbital_delivery_id, hirs_ctp_daily_delivery_id,
@@ -110,54 +125,63 @@ class HIRS_TPW_ORBITAL(Computation):
 
         return cfsr_file
 
-    @reraise_as(WorkflowNotReady, FileNotFound, prefix='HIRS_TPW_ORBITAL')
-    def build_task(self, context, task):
+    def hirs2nc_product(self, context):
         '''
-        Build up a set of inputs for a single context
+        Return the hirs2nc product required by the context.
         '''
         global delta_catalog
 
-        LOG.debug("Running build_task()")
-
         # Initialize the hirs2nc module with the data locations
         hirs2nc.delta_catalog = delta_catalog
 
-        # Instantiate the hirs2nc and hirs_ctp_orbital computations
-        hirs2nc_comp = hirs2nc.HIRS2NC()
-        hirs_ctp_orbital_comp = hirs_ctp_orbital.HIRS_CTP_ORBITAL()
+        hirs2nc_context ={
+            'satellite': context['satellite'],
+            'granule': context['granule'],
+            'hirs2nc_delivery_id': context['hirs2nc_delivery_id']}
+
+        return hirs2nc.HIRS2NC().dataset('out').product(hirs2nc_context)
+
+    def hirs_ctp_orbital_product(self, context):
+        '''
+        Return the CTP orbital product required by the context.
+        '''
+        hirs_ctp_orbital_context = context.copy()
+        [hirs_ctp_orbital_context.pop(k) for k in ['hirs_ctp_daily_delivery_id',
+                                                   'hirs_ctp_monthly_delivery_id',
+                                                   'hirs_tpw_orbital_delivery_id']]
+
+        return hirs_ctp_orbital.HIRS_CTP_ORBITAL().dataset('out').product(hirs_ctp_orbital_context)
+
+    @reraise_as(WorkflowNotReady, FileNotFound, prefix='HIRS_TPW_ORBITAL')
+    def build_task(self, context, task):
+        '''
+        Build up a set of inputs for a single context
+        '''
+
+        LOG.debug("Running build_task()")
 
         SPC = StoredProductCatalog()
 
         #
         # HIRS L1B Input
         #
-        hirs2nc_context ={
-            'satellite': context['satellite'],
-            'granule': context['granule'],
-            'hirs2nc_delivery_id': context['hirs2nc_delivery_id']}
-
-        hirs2nc_prod = hirs2nc_comp.dataset('out').product(hirs2nc_context)
+        hirs2nc_prod = self.hirs2nc_product(context)
 
         if SPC.exists(hirs2nc_prod):
             task.input('HIR1B', hirs2nc_prod)
         else:
-            raise WorkflowNotReady('No HIRS inputs available for {}'.format(hirs2nc_context['granule']))
+            raise WorkflowNotReady('No HIRS inputs available for {}'.format(context['granule']))
 
         #
         # CTP Orbital Input
         #
-        hirs_ctp_orbital_context = context.copy()
-        [hirs_ctp_orbital_context.pop(k) for k in ['hirs_ctp_daily_delivery_id',
-                                                   'hirs_ctp_monthly_delivery_id',
-                                                   'hirs_tpw_orbital_delivery_id']]
-
-        hirs_ctp_orbital_prod = hirs_ctp_orbital_comp.dataset('out').product(hirs_ctp_orbital_context)
+        hirs_ctp_orbital_prod = self.hirs_ctp_orbital_product(context)
 
         if SPC.exists(hirs_ctp_orbital_prod):
             task.input('CTPO', hirs_ctp_orbital_prod)
         else:
             raise WorkflowNotReady('No HIRS CTP Orbital inputs available for {}'.format(
-                hirs_ctp_orbital_context['granule']))
+                context['granule']))
 
         #
         # CFSR Input
@@ -179,7 +203,9 @@ class HIRS_TPW_ORBITAL(Computation):
     def extract_bin_from_cfsr(self, inputs, context):
         '''
         Run wgrib2 on the  input CFSR grib files, to create flat binary files
-        containing the desired data.
+        containing the desired data. If extract_cfsr_in_process is set, the
+        surface pressure is decoded in-process instead (see cfsr.py), falling
+        back to the wgrib2 script on failure.
         '''
 
         # Where are we running the package
@@ -202,6 +228,19 @@ class HIRS_TPW_ORBITAL(Computation):
         new_cfsr_files = []
 
         output_cfsr_file = '{}.bin'.format(basename(cfsr_file))
+
+        if self.extract_cfsr_in_process:
+            if cfsr.have_inprocess_extractor():
+                try:
+                    LOG.debug("Extracting surface pressure in-process to {}".format(output_cfsr_file))
+                    cfsr.extract_psfc_bin(cfsr_file, output_cfsr_file)
+                    return rc, output_cfsr_file
+                except Exception as err:
+                    LOG.warn("In-process CFSR extraction failed ({}), falling back to {}".format(
+                        err, extract_cfsr_bin))
+            else:
+                LOG.warn("eccodes is unavailable, falling back to {}".format(extract_cfsr_bin))
+
         cmd = '{} {} {} {}'.format(extract_cfsr_bin, dist_root, cfsr_file, output_cfsr_file)
         #cmd = 'sleep 0; touch {}'.format(output_cfsr_file) # DEBUG
 
@@ -382,6 +421,13 @@ class HIRS_TPW_ORBITAL(Computation):
             LOG.debug("run_task() context['{}'] = {}".format(key, context[key]))
 
         rc = 0
+        start_time = time.time()
+        input_bytes = None
+        if metrics_file is not None:
+            try:
+                input_bytes = sum(os.path.getsize(input_file) for input_file in inputs.values())
+            except (IOError, OSError, TypeError) as err:
+                LOG.warn("Failed to size the task inputs for the metrics: {}".format(err))
 
         # Extract a binary array from a CFSR reanalysis GRIB2 file on a
         # global equal angle grid at 0.5 degree resolution. CFSR files
@@ -403,9 +449,21 @@ class HIRS_TPW_ORBITAL(Computation):
         extra_attrs = {'begin_time': interval.left,
                        'end_time': interval.right}
 
+        tpw_orbital_shift_file = nc_compress(tpw_orbital_shift_file)
+        tpw_orbital_noshift_file = nc_compress(tpw_orbital_noshift_file)
+
+        # Record the cost of this context for the campaign planner
+        if input_bytes is not None:
+            try:
+                io_bytes = input_bytes + sum(os.path.getsize(output_file) for output_file in
+                                             [cfsr_file, tpw_orbital_shift_file, tpw_orbital_noshift_file])
+                record_metrics(metrics_file, context, time.time() - start_time, io_bytes)
+            except (IOError, OSError, TypeError) as err:
+                LOG.warn("Failed to record task metrics in {}: {}".format(metrics_file, err))
+
         return {
                 'shift': {
-                    'file': nc_compress(tpw_orbital_shift_file), 'extra_attrs': extra_attrs},
+                    'file': tpw_orbital_shift_file, 'extra_attrs': extra_attrs},
                 'noshift': {
-                    'file': nc_compress(tpw_orbital_noshift_file), 'extra_attrs': extra_attrs}
+                    'file': tpw_orbital_noshift_file, 'extra_attrs': extra_attrs}
                 }
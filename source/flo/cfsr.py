@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+
+Purpose: Optional, experimental in-process extraction of the CFSR surface
+         pressure field, as an alternative to extract_ncep_cfsr_psfc.csh and
+         wgrib2. It is not a replacement for the script until
+         benchmark_cfsr_extract.py has passed on both CFSR_PGRBHANL and
+         CFSV2_PGRBHANL files.
+
+The output is meant to reproduce the flat binary written by "wgrib2 -bin", which is
+what hirs_regrtvl_main_cdf.exe reads: a single record of native 32-bit
+floats in we:sn order (wgrib2's default output order), optionally wrapped
+in 4-byte Fortran record markers.
+
+Only the GRIB2 section headers are read while scanning the CFSR file; the
+data section of the surface pressure message is the only one unpacked.
+
+UNVERIFIED: byte-identical output against extract_ncep_cfsr_psfc.csh has not
+yet been confirmed on real CFSR_PGRBHANL or CFSV2_PGRBHANL files. Two
+assumptions need checking with benchmark_cfsr_extract.py before relying on
+it: that the script calls wgrib2 "-bin" with Fortran record markers in the
+default we:sn order, and that eccodes (which unpacks in double precision,
+cast here to float32) agrees with wgrib2's single precision unpacking to the
+last bit. Values may differ by 1 ULP where the latter does not hold.
+
+Copyright (c) 2015 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import struct
+import filecmp
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import eccodes
+except ImportError:
+    eccodes = None
+
+# every module should have a LOG object
+LOG = logging.getLogger(__name__)
+
+# GRIB2 identification of PRES:surface (discipline, category, number, level type)
+PSFC_DISCIPLINE = 0
+PSFC_CATEGORY = 3
+PSFC_NUMBER = 0
+PSFC_LEVEL_TYPE = 1
+
+# wgrib2 writes undefined grid points with this value
+WGRIB2_UNDEFINED = 9.999e20
+
+
+class CFSRExtractError(Exception):
+    pass
+
+
+def have_inprocess_extractor():
+    '''
+    Return True if numpy and the GRIB2 decoder needed by the in-process
+    extractor are importable.
+    '''
+    return np is not None and eccodes is not None
+
+
+def _grib2_messages(fobj):
+    '''
+    Generator over the GRIB2 messages in an open file, yielding the byte offset
+    and total length of each message, the (discipline, category, number, level
+    type) tuple read from sections 0 and 4, and the product definition template
+    number. Data sections are skipped over.
+    '''
+    offset = 0
+    while True:
+        fobj.seek(offset)
+        sec0 = fobj.read(16)
+        if len(sec0) < 16:
+            return
+        if sec0[:4] != b'GRIB':
+            raise CFSRExtractError('Expected GRIB indicator at byte {}'.format(offset))
+        discipline = struct.unpack('>B', sec0[6:7])[0]
+        edition = struct.unpack('>B', sec0[7:8])[0]
+        if edition != 2:
+            raise CFSRExtractError('GRIB edition {} at byte {} is not supported'.format(
+                edition, offset))
+        msg_length = struct.unpack('>Q', sec0[8:16])[0]
+        if msg_length < 20:
+            raise CFSRExtractError('Bad message length {} at byte {}'.format(msg_length, offset))
+
+        # Walk sections 1-7 until we find the product definition (section 4)
+        key = None
+        template = None
+        pos = offset + 16
+        end = offset + msg_length - 4
+        while pos < end:
+            fobj.seek(pos)
+            header = fobj.read(5)
+            if len(header) < 5:
+                raise CFSRExtractError('Truncated section header at byte {}'.format(pos))
+            sec_length, sec_number = struct.unpack('>IB', header)
+            if sec_length < 5 or pos + sec_length > end:
+                raise CFSRExtractError('Bad length {} for section {} at byte {}'.format(
+                    sec_length, sec_number, pos))
+            if sec_number == 4:
+                # Octets 8-9: template number; octets 10-11: parameter category and
+                # number; octet 23: first fixed surface (for template 4.0)
+                sec4 = fobj.read(18)
+                if len(sec4) < 18:
+                    raise CFSRExtractError('Truncated section 4 at byte {}'.format(pos))
+                template = struct.unpack('>H', sec4[2:4])[0]
+                category, number = struct.unpack('>BB', sec4[4:6])
+                level_type = struct.unpack('>B', sec4[17:18])[0]
+                key = (discipline, category, number, level_type)
+                break
+            pos += sec_length
+
+        yield offset, msg_length, key, template
+        offset += msg_length
+
+
+def find_psfc_message(cfsr_file):
+    '''
+    Return the (offset, length) of the surface pressure message in a CFSR
+    (CFSR_PGRBHANL or CFSV2_PGRBHANL) GRIB2 file.
+    '''
+    target = (PSFC_DISCIPLINE, PSFC_CATEGORY, PSFC_NUMBER, PSFC_LEVEL_TYPE)
+    with open(cfsr_file, 'rb') as fobj:
+        for offset, msg_length, key, template in _grib2_messages(fobj):
+            if key == target:
+                if template != 0:
+                    raise CFSRExtractError(
+                        'Surface pressure at byte {} of {} uses product definition template '
+                        '4.{}, only 4.0 is supported'.format(offset, cfsr_file, template))
+                return offset, msg_length
+
+    raise CFSRExtractError('No surface pressure message in {}'.format(cfsr_file))
+
+
+def read_psfc(cfsr_file):
+    '''
+    Decode the surface pressure field from a CFSR GRIB2 file, returning a
+    (Nj, Ni) float32 array in we:sn order.
+    '''
+    if not have_inprocess_extractor():
+        raise CFSRExtractError('numpy and eccodes are required for in-process CFSR extraction')
+
+    offset, msg_length = find_psfc_message(cfsr_file)
+    LOG.debug("Surface pressure message at bytes {}-{} of {}".format(
+        offset, offset + msg_length, cfsr_file))
+
+    with open(cfsr_file, 'rb') as fobj:
+        fobj.seek(offset)
+        message = fobj.read(msg_length)
+
+    gid = eccodes.codes_new_from_message(message)
+    try:
+        ni = eccodes.codes_get(gid, 'Ni')
+        nj = eccodes.codes_get(gid, 'Nj')
+        i_negative = eccodes.codes_get(gid, 'iScansNegatively')
+        j_positive = eccodes.codes_get(gid, 'jScansPositively')
+        j_consecutive = eccodes.codes_get(gid, 'jPointsAreConsecutive')
+        if j_consecutive:
+            raise CFSRExtractError('Column-major (jPointsAreConsecutive) grids are not supported')
+        eccodes.codes_set(gid, 'missingValue', WGRIB2_UNDEFINED)
+        values = eccodes.codes_get_values(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+    data = values.astype(np.float32).reshape(nj, ni)
+    if i_negative:
+        data = data[:, ::-1]
+    if not j_positive:
+        data = data[::-1, :]
+
+    return data
+
+
+def write_bin(data, output_file, header=True):
+    '''
+    Write a 2D float32 array to output_file through a memory-mapped buffer,
+    using the "wgrib2 -bin" layout. If header is True the record is wrapped in
+    4-byte Fortran record markers, as wgrib2 does unless given -no_header.
+    '''
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    marker = np.array([data.nbytes], dtype=np.int32)
+    header_bytes = marker.nbytes if header else 0
+    file_size = data.nbytes + 2 * header_bytes
+
+    out = np.memmap(output_file, dtype=np.uint8, mode='w+', shape=(file_size,))
+    try:
+        if header:
+            out[:header_bytes] = marker.view(np.uint8)
+            out[-header_bytes:] = marker.view(np.uint8)
+        out[header_bytes:header_bytes + data.nbytes] = data.reshape(-1).view(np.uint8)
+        out.flush()
+    finally:
+        del out
+
+    return output_file
+
+
+def extract_psfc_bin(cfsr_file, output_file, header=True):
+    '''
+    Extract the surface pressure from cfsr_file into the flat binary output_file.
+    '''
+    data = read_psfc(cfsr_file)
+    LOG.debug("Writing {}x{} surface pressure grid to {}".format(
+        data.shape[0], data.shape[1], output_file))
+    return write_bin(data, output_file, header=header)
+
+
+def compare_bin(file_a, file_b):
+    '''
+    Return True if the two flat binary files are byte-identical.
+    '''
+    if os.path.getsize(file_a) != os.path.getsize(file_b):
+        LOG.warn("{} and {} differ in size".format(file_a, file_b))
+        return False
+
+    return filecmp.cmp(file_a, file_b, shallow=False)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+
+Purpose: Runtime cost model and campaign planner for hirs_tpw_orbital
+         reprocessing, learnt from historical run metrics.
+
+The run metrics are read from a CSV file with one row per completed task and
+the columns
+
+    satellite,hirs_tpw_orbital_delivery_id,granule,runtime,io_bytes
+
+where runtime is the task wall time in seconds and io_bytes the bytes read
+and written by the task. HIRS_TPW_ORBITAL.run_task() appends a row for each
+context it runs when the metrics file is set, either by the
+HIRS_TPW_ORBITAL_METRICS environment variable or set_metrics_file(). Tasks
+run in their own scratch directories on many hosts, so the path must be on a
+filesystem shared with the submitting host; relative paths are made absolute
+where they are set. Appends are serialised with an fcntl lock.
+
+Copyright (c) 2015 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import csv
+import math
+import fcntl
+import logging
+
+# every module should have a LOG object
+LOG = logging.getLogger(__name__)
+
+# Used when there are no metrics at all for a satellite
+DEFAULT_RUNTIME = 120.
+DEFAULT_IO_BYTES = 200.e6
+
+METRICS_ENV = 'HIRS_TPW_ORBITAL_METRICS'
+METRICS_FIELDS = ['satellite', 'hirs_tpw_orbital_delivery_id', 'granule', 'runtime', 'io_bytes']
+
+
+def metrics_file_from_env():
+    '''
+    Return the absolute path of the metrics file named by $HIRS_TPW_ORBITAL_METRICS, or None.
+    '''
+    metrics_file = os.environ.get(METRICS_ENV)
+    return os.path.abspath(metrics_file) if metrics_file else None
+
+
+def record_metrics(metrics_file, context, runtime, io_bytes):
+    '''
+    Append the runtime and I/O of a completed context to the metrics file,
+    writing the header first if the file is empty. The file is locked for the
+    append, as many tasks write to it concurrently.
+    '''
+    row = {'satellite': context['satellite'],
+           'hirs_tpw_orbital_delivery_id': context['hirs_tpw_orbital_delivery_id'],
+           'granule': context['granule'].strftime('%Y-%m-%dT%H:%M:%S'),
+           'runtime': '{:.1f}'.format(runtime),
+           'io_bytes': '{:d}'.format(int(io_bytes))}
+
+    with open(metrics_file, 'a') as fobj:
+        fcntl.lockf(fobj, fcntl.LOCK_EX)
+        try:
+            fobj.seek(0, os.SEEK_END)
+            writer = csv.DictWriter(fobj, METRICS_FIELDS)
+            if fobj.tell() == 0:
+                writer.writeheader()
+            writer.writerow(row)
+            fobj.flush()
+        finally:
+            fcntl.lockf(fobj, fcntl.LOCK_UN)
+
+    LOG.debug("Recorded {} in {}".format(row, metrics_file))
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.runtime = 0.
+        self.io_bytes = 0.
+
+    def add(self, runtime, io_bytes):
+        self.count += 1
+        self.runtime += runtime
+        self.io_bytes += io_bytes
+
+    def mean(self):
+        return self.runtime / self.count, self.io_bytes / self.count
+
+
+class CostModel(object):
+    '''
+    Mean per-task runtime and I/O, keyed on satellite and TPW delivery. Contexts
+    for a delivery without metrics fall back to the satellite mean, then to the
+    mean over all satellites.
+    '''
+
+    def __init__(self, default_runtime=DEFAULT_RUNTIME, default_io_bytes=DEFAULT_IO_BYTES):
+        self.default = (default_runtime, default_io_bytes)
+        self.by_delivery = {}
+        self.by_satellite = {}
+        self.overall = _Stats()
+
+    def add(self, satellite, delivery_id, runtime, io_bytes=0.):
+        self.by_delivery.setdefault((satellite, delivery_id), _Stats()).add(runtime, io_bytes)
+        self.by_satellite.setdefault(satellite, _Stats()).add(runtime, io_bytes)
+        self.overall.add(runtime, io_bytes)
+
+    def load(self, metrics_file):
+        '''
+        Add the task metrics in a CSV file to the model.
+        '''
+        count = 0
+        with open(metrics_file) as fobj:
+            for row in csv.DictReader(fobj):
+                try:
+                    self.add(row['satellite'], row['hirs_tpw_orbital_delivery_id'],
+                             float(row['runtime']), float(row.get('io_bytes') or 0.))
+                    count += 1
+                except (KeyError, ValueError) as err:
+                    LOG.warn("Skipping bad metrics row {}: {}".format(row, err))
+
+        LOG.info("Loaded {} task metrics from {}".format(count, metrics_file))
+        return self
+
+    def predict(self, context):
+        '''
+        Return the expected (runtime, io_bytes) of a single context.
+        '''
+        key = (context['satellite'], context.get('hirs_tpw_orbital_delivery_id'))
+        if key in self.by_delivery:
+            return self.by_delivery[key].mean()
+        if context['satellite'] in self.by_satellite:
+            return self.by_satellite[context['satellite']].mean()
+        if self.overall.count:
+            return self.overall.mean()
+        return self.default
+
+
+class CampaignPlanner(object):
+    '''
+    Predict the cost of a set of contexts, and split them into order batches
+    which each take roughly a target wall time to run.
+
+    concurrency is the number of task slots available, io_bandwidth (bytes/s,
+    optional) the aggregate I/O throughput shared by those slots.
+    '''
+
+    def __init__(self, model, concurrency, io_bandwidth=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1, not {}'.format(concurrency))
+        self.model = model
+        self.concurrency = concurrency
+        self.io_bandwidth = io_bandwidth
+
+        if not model.overall.count:
+            LOG.warn("The cost model has no task metrics, every context will be costed at "
+                     "{:.0f}s and {:.0f} MB".format(model.default[0], model.default[1] / 1.e6))
+
+    def wall_time(self, runtimes, io_bytes):
+        '''
+        Lower bound on the wall time to run tasks with the given runtimes and total I/O.
+        '''
+        if not runtimes:
+            return 0.
+        wall_time = max(sum(runtimes) / self.concurrency, max(runtimes))
+        if self.io_bandwidth:
+            wall_time = max(wall_time, io_bytes / self.io_bandwidth)
+        return wall_time
+
+    def predict(self, contexts):
+        '''
+        Return a dictionary of the total runtime, I/O and wall time of contexts.
+        '''
+        costs = [self.model.predict(context) for context in contexts]
+        runtimes = [runtime for runtime, io_bytes in costs]
+        total_io = sum(io_bytes for runtime, io_bytes in costs)
+
+        return {'contexts': len(contexts),
+                'runtime': sum(runtimes),
+                'io_bytes': total_io,
+                'wall_time': self.wall_time(runtimes, total_io)}
+
+    def batches(self, contexts, target_duration):
+        '''
+        Split contexts, in satellite and granule order, into contiguous batches
+        of near equal predicted cost, each taking about target_duration seconds.
+        '''
+        if target_duration <= 0:
+            raise ValueError('target_duration must be positive, not {}'.format(target_duration))
+
+        contexts = sorted(contexts, key=lambda c: (c['satellite'], c['granule']))
+        if not contexts:
+            return []
+
+        prediction = self.predict(contexts)
+        num_batches = int(math.ceil(prediction['wall_time'] / target_duration))
+        num_batches = max(1, min(num_batches, len(contexts)))
+        LOG.debug("Splitting {} contexts ({:.0f}s) into {} batches".format(
+            len(contexts), prediction['wall_time'], num_batches))
+
+        # Cut the cumulative cost at equal fractions of the total
+        batch_cost = prediction['runtime'] / num_batches
+        batches = [[]]
+        cumulative = 0.
+        for context in contexts:
+            runtime = self.model.predict(context)[0]
+            boundary = batch_cost * len(batches)
+            if batches[-1] and len(batches) < num_batches and cumulative + runtime / 2. > boundary:
+                batches.append([])
+            batches[-1].append(context)
+            cumulative += runtime
+
+        return batches
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+
+Purpose: Track which upstream inputs (hirs2nc, CTP orbital and CFSR) each
+         hirs_tpw_orbital context is waiting on, and release contexts for
+         submission as soon as all of them exist.
+
+Blocked contexts are only re-checked for the inputs they are still missing.
+The catalogs are polled with an exponential backoff, and a poll is triggered
+immediately when an upstream arrival is reported through notify(), so a
+notification service can cut the latency further. SpoolNotifier is a local
+stand-in for one, turning marker files dropped in a directory into notify()
+calls.
+
+Copyright (c) 2015 University of Wisconsin Regents.
+Licensed under GNU GPLv3.
+"""
+
+import os
+import time
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from flo.product import StoredProductCatalog
+from timeutil import datetime, timedelta, round_datetime
+
+# every module should have a LOG object
+LOG = logging.getLogger(__name__)
+
+INPUTS = ['HIR1B', 'CTPO', 'CFSR']
+
+
+def context_key(context):
+    return tuple(sorted(context.items()))
+
+
+class ReadinessTracker(object):
+    '''
+    Keep the set of blocked contexts of a HIRS_TPW_ORBITAL computation, and
+    the inputs each of them is missing.
+    '''
+
+    def __init__(self, comp, initial_delay=60., max_delay=3600., backoff=2., batch_window=60.):
+        self.comp = comp
+        self.batch_window = batch_window
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.blocked = {}
+        self.events = Queue()
+        self.SPC = StoredProductCatalog()
+
+    def _input_exists(self, context, name, cfsr_cache):
+        if name == 'HIR1B':
+            return self.SPC.exists(self.comp.hirs2nc_product(context))
+        if name == 'CTPO':
+            return self.SPC.exists(self.comp.hirs_ctp_orbital_product(context))
+
+        # Many contexts share a CFSR file, so only look each one up once per check
+        cfsr_granule = round_datetime(context['granule'], timedelta(hours=6))
+        if cfsr_granule not in cfsr_cache:
+            cfsr_cache[cfsr_granule] = self.comp.get_cfsr(cfsr_granule) is not None
+        return cfsr_cache[cfsr_granule]
+
+    def _check(self, keys, names=None):
+        '''
+        Re-check the missing inputs of the blocked contexts in keys (only those
+        in names, if given), returning the contexts which are now ready.
+        '''
+        released = []
+        cfsr_cache = {}
+        for key in keys:
+            context, missing = self.blocked[key]
+            for name in sorted(missing):
+                if names is not None and name not in names:
+                    continue
+                try:
+                    exists = self._input_exists(context, name, cfsr_cache)
+                except Exception as err:
+                    # Leave the input missing and try again on the next check
+                    LOG.warn("Failed to check {} for {}: {}".format(name, context['granule'], err))
+                    continue
+                if exists:
+                    missing.discard(name)
+            if not missing:
+                del self.blocked[key]
+                released.append(context)
+
+        if released:
+            LOG.info("Released {} contexts, {} still blocked".format(len(released), len(self.blocked)))
+
+        return released
+
+    def add(self, contexts):
+        '''
+        Start tracking contexts, returning those whose inputs all already exist.
+        '''
+        keys = []
+        for context in contexts:
+            key = context_key(context)
+            if key not in self.blocked:
+                self.blocked[key] = (context, set(INPUTS))
+                keys.append(key)
+
+        return self._check(keys)
+
+    def waiting_on(self):
+        '''
+        Return a dictionary of the number of blocked contexts missing each input.
+        '''
+        counts = dict((name, 0) for name in INPUTS)
+        for context, missing in self.blocked.values():
+            for name in missing:
+                counts[name] += 1
+        return counts
+
+    def notify(self, name, granule, satellite=None):
+        '''
+        Report the arrival of an input. granule is the granule of a hirs2nc or
+        CTP orbital product, or the analysis time of a CFSR file. Safe to call
+        from another thread.
+        '''
+        if name not in INPUTS:
+            raise ValueError('Unknown input {}, expected one of {}'.format(name, INPUTS))
+        self.events.put((name, granule, satellite))
+
+    def _matching(self, name, granule, satellite):
+        keys = []
+        for key, (context, missing) in self.blocked.items():
+            if name not in missing:
+                continue
+            if name == 'CFSR':
+                if (round_datetime(context['granule'], timedelta(hours=6)) !=
+                        round_datetime(granule, timedelta(hours=6))):
+                    continue
+            elif context['granule'] != granule:
+                continue
+            if satellite is not None and context['satellite'] != satellite:
+                continue
+            keys.append(key)
+        return keys
+
+    def poll(self):
+        '''
+        Re-check every blocked context, returning the contexts which are now ready.
+        '''
+        return self._check(list(self.blocked.keys()))
+
+    def run(self, submit, timeout=None, max_empty_polls=None):
+        '''
+        Until no contexts are blocked, timeout seconds pass or max_empty_polls
+        successive polls release nothing, wait for notifications or the next
+        poll, passing newly ready contexts to submit(). Contexts released by
+        notifications arriving within batch_window seconds of each other are
+        submitted together.
+        '''
+        delay = self.initial_delay
+        next_poll = time.time() + delay
+        end_time = None if timeout is None else time.time() + timeout
+        empty_polls = 0
+        pending = []
+        flush_time = None
+
+        while self.blocked or pending:
+            now = time.time()
+            if pending and (now >= flush_time or not self.blocked):
+                submit(pending)
+                pending = []
+                flush_time = None
+                continue
+
+            stop = None
+            if end_time is not None and now >= end_time:
+                stop = "Timed out"
+            elif max_empty_polls is not None and empty_polls >= max_empty_polls:
+                stop = "Giving up after {} empty polls".format(empty_polls)
+            if stop is not None:
+                LOG.warn("{} with {} contexts blocked: {}".format(
+                    stop, len(self.blocked), self.waiting_on()))
+                if pending:
+                    submit(pending)
+                break
+
+            wait = next_poll - now
+            if end_time is not None:
+                wait = min(wait, end_time - now)
+            if flush_time is not None:
+                wait = min(wait, flush_time - now)
+
+            try:
+                name, granule, satellite = self.events.get(timeout=max(wait, 0.))
+                LOG.debug("Notified of {} {} {}".format(name, granule, satellite or ''))
+                released = self._check(self._matching(name, granule, satellite), names=[name])
+                if released and flush_time is None:
+                    flush_time = time.time() + self.batch_window
+            except Empty:
+                if time.time() < next_poll:
+                    # Woken to flush the pending contexts or to time out
+                    continue
+                LOG.debug("Polling {} blocked contexts: {}".format(len(self.blocked), self.waiting_on()))
+                released = self.poll()
+                if released:
+                    flush_time = time.time()
+                else:
+                    delay = min(delay * self.backoff, self.max_delay)
+                    empty_polls += 1
+                next_poll = time.time() + delay
+
+            if released:
+                pending.extend(released)
+                delay = self.initial_delay
+                empty_polls = 0
+                next_poll = time.time() + delay
+
+
+class SpoolNotifier(threading.Thread):
+    '''
+    A local stand-in for an upstream notification service. Upstream jobs (or an
+    operator) drop empty marker files into spool_dir, named
+
+        <input>.<satellite>.<%Y%m%dT%H%M%S>    e.g. CTPO.metop-b.20161201T003200
+        CFSR.<%Y%m%dT%H%M%S>                   e.g. CFSR.20161201T060000
+
+    and this thread passes each one to tracker.notify() and removes it.
+    '''
+
+    def __init__(self, tracker, spool_dir, interval=5.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.tracker = tracker
+        self.spool_dir = spool_dir
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def parse(self, marker):
+        fields = marker.split('.')
+        if len(fields) == 2 and fields[0] == 'CFSR':
+            name, satellite, granule = fields[0], None, fields[1]
+        elif len(fields) == 3 and fields[0] in INPUTS:
+            name, satellite, granule = fields
+        else:
+            raise ValueError('Unrecognised marker file {}'.format(marker))
+        return name, datetime.strptime(granule, '%Y%m%dT%H%M%S'), satellite
+
+    def scan(self):
+        for marker in sorted(os.listdir(self.spool_dir)):
+            try:
+                self.tracker.notify(*self.parse(marker))
+            except ValueError as err:
+                LOG.warn("{}".format(err))
+            try:
+                os.remove(os.path.join(self.spool_dir, marker))
+            except OSError as err:
+                LOG.warn("Failed to remove marker {}: {}".format(marker, err))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except OSError as err:
+                LOG.warn("Failed to scan {}: {}".format(self.spool_dir, err))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -3,18 +3,19 @@ import sys
 import time
 import re
 import string
-from datetime import datetime, timedelta
 from calendar import monthrange
 import logging
 import traceback
 
-from flo.time import TimeInterval
+from timeutil import TimeInterval, datetime, timedelta
 from flo.ui import safe_submit_order
 from flo.product import StoredProductCatalog
 
-from flo.sw.hirs import HIRS
-from flo.sw.hirs_ctp_orbital import HIRS_CTP_ORBITAL
-from flo.sw.hirs_tpw_orbital import HIRS_TPW_ORBITAL
+import flo.sw.hirs2nc as hirs2nc
+import flo.sw.hirs_ctp_orbital as hirs_ctp_orbital
+import flo.sw.hirs_tpw_orbital as hirs_tpw_orbital
+from flo.sw.hirs_tpw_orbital.planner import CostModel, CampaignPlanner, METRICS_ENV, metrics_file_from_env
+from flo.sw.hirs_tpw_orbital.readiness import ReadinessTracker, SpoolNotifier
 
 # every module should have a LOG object
 LOG = logging.getLogger(__name__)
@@ -28,21 +29,24 @@ logging.basicConfig(stream=sys.stdout, level=levels[0],
                     datefmt=dateFormat)
 
 # General information
-comp = HIRS_TPW_ORBITAL()
+comp = hirs_tpw_orbital.HIRS_TPW_ORBITAL()
 SPC = StoredProductCatalog()
 
-# Latest Computation versions.
-hirs_version  = 'v20151014'
-collo_version = 'v20151014'
-csrb_version  = 'v20150915'
-ctp_version   = 'v20150915'
-tpw_version   = 'v20160222'
+# Latest delivery IDs
+hirs2nc_delivery_id = '20180410-1'
+hirs_avhrr_delivery_id = '20180505-1'
+hirs_csrb_daily_delivery_id  = '20180714-1'
+hirs_csrb_monthly_delivery_id  = '20180516-1'
+hirs_ctp_orbital_delivery_id  = '20180730-1'
+hirs_ctp_daily_delivery_id  = '20180802-1'
+hirs_ctp_monthly_delivery_id  = '20180803-1'
+hirs_tpw_orbital_delivery_id = '20190205-1'
 
 platform_choices = ['noaa-06', 'noaa-07', 'noaa-08', 'noaa-09', 'noaa-10', 'noaa-11',
                     'noaa-12', 'noaa-14', 'noaa-15', 'noaa-16', 'noaa-17', 'noaa-18',
                     'noaa-19', 'metop-a', 'metop-b']
 
-platform = 'metop-b'
+platforms = ['metop-b']
 
 # Specify the intervals
 wedge = timedelta(seconds=1.)
@@ -61,37 +65,95 @@ wedge = timedelta(seconds=1.)
     #TimeInterval(datetime(2016, 12, 1),datetime(2017, 1, 1) - wedge),
 #]
 
-# Examine how many of the defined contexts are populated
-intervals = []
+# Campaign planning: the cost model is learnt from the metrics written by previous tasks, to
+# the same $HIRS_TPW_ORBITAL_METRICS file (on a shared filesystem) that the tasks append to.
+# io_bandwidth (bytes/s) is the aggregate I/O throughput available to the concurrent tasks.
+metrics_file = metrics_file_from_env() or os.path.abspath('hirs_tpw_orbital_metrics.csv')
+concurrency = 40
+io_bandwidth = 500.e6
+target_duration = 6 * 3600.
+
+# Keep waiting for the upstream inputs of blocked contexts, rather than rerunning this script,
+# giving up after wait_timeout seconds or max_empty_polls polls which release nothing.
+# Upstream arrivals can also be announced with marker files in notify_dir (see SpoolNotifier).
+wait_for_inputs = False
+wait_timeout = 24 * 3600.
+max_empty_polls = 10
+notify_dir = None
+
 year,month = 2016,12
-days = range(1,monthrange(year, month)[1]+1)
-for day in days:
-    dt_start = datetime(year, month, day)
-    dt_end = datetime(year, month, day) + timedelta(days = 1)
-    interval = TimeInterval(dt_start, dt_end - wedge)
-    contexts = comp.find_contexts(platform, hirs_version, collo_version, csrb_version, ctp_version,
-                               tpw_version, interval)
-    num_contexts_exist = 0
-    for context in contexts:
-        num_contexts_exist += SPC.exists(comp.dataset('out').product(context))
-    LOG.info("Interval {} has {}/{} contexts existing".format(interval, num_contexts_exist, len(contexts)))
-    missing_contexts = len(contexts) - num_contexts_exist
-    if missing_contexts > 3:
-        intervals.append(interval)
-
-
-LOG.info("Submitting intervals...")
-for interval in intervals:
-    LOG.info("Submitting interval {} -> {}".format(interval.left, interval.right))
-    contexts = comp.find_contexts(platform, hirs_version, collo_version, csrb_version, ctp_version,
-                               tpw_version, interval)
-    LOG.info("\tThere are {} contexts in this interval".format(len(contexts)))
-    contexts.sort()
-    for context in contexts:
-        LOG.debug(context)
-    LOG.info("\tFirst context: {}".format(contexts[0]))
-    LOG.info("\tLast context:  {}".format(contexts[-1]))
-    LOG.info("\t{}".format(safe_submit_order(comp,
-                                             [comp.dataset('out')],
-                                             contexts,
-                                             download_onlies=[HIRS(), HIRS_CTP_ORBITAL()])))
+interval = TimeInterval(datetime(year, month, 1),
+                        datetime(year, month, monthrange(year, month)[1]) + timedelta(days=1) - wedge)
+
+model = CostModel()
+if os.path.exists(metrics_file):
+    model.load(metrics_file)
+else:
+    LOG.warn("No task metrics file {}, set {} for the tasks to write it".format(
+        metrics_file, METRICS_ENV))
+planner = CampaignPlanner(model, concurrency, io_bandwidth=io_bandwidth)
+
+def set_input_sources(satellite):
+
+    input_data = {'HIR1B': '/mnt/software/flo/hirs_l1b_datalists/{0:}/HIR1B_{0:}_latest'.format(satellite),
+                  'CFSR':  '/mnt/cephfs_data/geoffc/hirs_data_lists/CFSR.out',
+                  'PTMSX': '/mnt/software/flo/hirs_l1b_datalists/{0:}/PTMSX_{0:}_latest'.format(satellite)}
+
+    # Data locations
+    collection = {'HIR1B': 'ARCDATA',
+                  'CFSR': 'DELTA',
+                  'PTMSX': 'APOLLO'}
+
+    hirs_tpw_orbital.set_input_sources({'collection':collection, 'input_data':input_data})
+
+# Only plan the contexts which don't yet have both outputs
+contexts = []
+for platform in platforms:
+    set_input_sources(platform)
+    contexts += comp.find_contexts(interval, platform, hirs2nc_delivery_id, hirs_avhrr_delivery_id,
+                                   hirs_csrb_daily_delivery_id, hirs_csrb_monthly_delivery_id,
+                                   hirs_ctp_orbital_delivery_id, hirs_ctp_daily_delivery_id,
+                                   hirs_ctp_monthly_delivery_id, hirs_tpw_orbital_delivery_id)
+missing_contexts = [context for context in contexts
+                    if not all(SPC.exists(comp.dataset(output).product(context))
+                               for output in comp.outputs)]
+LOG.info("Interval {} has {}/{} contexts missing".format(interval, len(missing_contexts), len(contexts)))
+
+def submit(contexts):
+    prediction = planner.predict(contexts)
+    LOG.info("Predicted cost: {:.1f} CPU hours, {:.1f} GB, {:.1f} hours wall time on {} slots".format(
+        prediction['runtime'] / 3600., prediction['io_bytes'] / 1.e9,
+        prediction['wall_time'] / 3600., concurrency))
+
+    LOG.info("Submitting batches...")
+    for batch in planner.batches(contexts, target_duration):
+        LOG.info("Submitting {} contexts ({:.1f} hours wall time)".format(
+            len(batch), planner.predict(batch)['wall_time'] / 3600.))
+        for context in batch:
+            LOG.debug(context)
+        LOG.info("\tFirst context: {}".format(batch[0]))
+        LOG.info("\tLast context:  {}".format(batch[-1]))
+        LOG.info("\t{}".format(safe_submit_order(comp,
+                                                 [comp.dataset(output) for output in comp.outputs],
+                                                 batch,
+                                                 download_onlies=[hirs2nc.HIRS2NC(),
+                                                                  hirs_ctp_orbital.HIRS_CTP_ORBITAL()])))
+
+# Only submit the contexts whose upstream inputs all exist
+tracker = ReadinessTracker(comp)
+ready_contexts = tracker.add(missing_contexts)
+LOG.info("{} contexts ready, blocked contexts waiting on {}".format(len(ready_contexts), tracker.waiting_on()))
+
+if ready_contexts:
+    submit(ready_contexts)
+
+if wait_for_inputs:
+    notifier = None
+    if notify_dir is not None:
+        notifier = SpoolNotifier(tracker, notify_dir)
+        notifier.start()
+    try:
+        tracker.run(submit, timeout=wait_timeout, max_empty_polls=max_empty_polls)
+    finally:
+        if notifier is not None:
+            notifier.stop()